@@ -9,11 +9,46 @@
 #
 # Written by swordstrike1.
 
-from serial import Serial
+from serial import Serial, SerialException
 from time import sleep, time
+from queue import Queue, Empty
+import threading
+import select
+import os
 import logging
+import re
 logger = logging.getLogger(__name__)
 
+# Responses ending with one of these terms are final.
+# A message body may be "OK" itself, so only the end of the buffer counts.
+_TERM_RE = re.compile(rb"(?:\r\nOK\r\n|\r\nERROR\r\n|> )\Z")
+_TERM_MAXLEN = len(b"\r\nERROR\r\n")
+# A line right after one of these headers is a message body, even if it
+# reads OK or ERROR.
+_BODY_HEADERS = (b"+CMGR:", b"+CMGL:")
+# Encoded stopterms, keyed by their string.
+_STOP_CACHE = {}
+# Encoded lines of the fixed commands, keyed by command.
+# Commands with arguments, such as a sim pin, are never kept.
+_ENCODED = {cmd: (cmd + "\r\n").encode() for cmd in [
+    "AT", "AT+CMGF=1", "AT+CNMI=2,1,0,0,0", "AT+CMGF=1;+CNMI=2,1,0,0,0",
+    "AT+CPIN?", "AT+CFUN=1,1", "AT+CMGD=1,3"]}
+_CTRLZ = bytes([26])
+# Most bytes taken from the port at once.
+_READ_SIZE = 8192
+# Silence that ends a burst of bytes when reading without select.
+_INTER_BYTE_TIMEOUT = 0.005
+# Command templates with parameters.
+_CPIN = "AT+CPIN={:s}".format
+_CMGS = "AT+CMGS=\"{:s}\"".format
+_CMGL = "AT+CMGL=\"{:s}\"".format
+_CMGR = "AT+CMGR={:d}".format
+_CMGD = "AT+CMGD={:d}".format
+# Unsolicited result codes, which may arrive at any moment.
+_URC_RE = re.compile(rb"\r\n(\+CMTI: [^\r\n]*)\r\n")
+_URC_START = b"\r\n+CMTI: "
+_CMTI_RE = re.compile(r'\+CMTI: "\w+",(\d+)$')
+
 
 class SMS_Group:
     UNREAD = "REC UNREAD"
@@ -39,7 +74,21 @@ class AT_Device:
     def __init__(self, path, baudrate=9600):
         """ Open AT device. Nothing else."""
         self.serial = Serial(path, timeout=0.5, baudrate=baudrate)
-        logger.debug("AT serial device opened at {:s}".format(path))
+        # Wait on the file descriptor where the platform allows it.
+        try:
+            self._fd = self.serial.fileno()
+        except (AttributeError, OSError):
+            self._fd = None
+            self.serial.inter_byte_timeout = _INTER_BYTE_TIMEOUT
+        self._buf = bytearray()
+        # Counts removals from the buffer, which invalidate scan offsets.
+        self._cuts = 0
+        self._cond = threading.Condition()
+        self._reader = None
+        self.urcs = Queue()
+        # Set when URCs may have been missed.
+        self.urcs_lost = False
+        logger.debug("AT serial device opened at %s", path)
 
     def __del__(self):
         """ Close AT device. """
@@ -47,106 +96,277 @@ class AT_Device:
 
     def write(self, cmd):
         """ Write a single line to the serial port. """
-        encoded = (cmd + "\r\n").encode()
+        encoded = _ENCODED.get(cmd)
+        if encoded is None:
+            encoded = (cmd + "\r\n").encode()
         self.serial.write(encoded)
-        logger.debug("WRITE: {:s}".format(cmd))
+        logger.debug("WRITE: %s", cmd)
         return Status.OK
 
-    def write_ctrlz(self):
-        """ Write the terminating CTRL-Z to end a prompt. """
-        self.serial.write(bytes([26]))
-        logger.debug("WRITE: Ctrl-Z")
+    def write_batch(self, cmds):
+        """ Write several commands as a single command line.
+        The device replies with one response for all of them. """
+        # Following commands are concatenated without their "AT" prefix.
+        line = cmds[0] + "".join(";" + cmd[2:] for cmd in cmds[1:])
+        return self.write(line)
+
+    def write_ctrlz(self, text=""):
+        """ Write the terminating CTRL-Z to end a prompt.
+        Text to enter at the prompt is written along with it. """
+        self.serial.write(text.encode() + _CTRLZ if text else _CTRLZ)
+        logger.debug("WRITE: %sCtrl-Z", text)
         return Status.OK
 
-    def has_terminator(response, stopterm=""):
-        """ Return True if response is final. """
-        # If the string ends with one of these terms, then we stop reading.
-        endterms = ["\r\nOK\r\n", "\r\nERROR\r\n", "> "]
-
-        # We can stop reading if either an endterm is detected or
-        # the stopterm is inside the string which causes immediate halt.
-        can_terminate = stopterm != "" and stopterm in response
-        for s in endterms:
-            if response.endswith(s):
-                can_terminate = True
-                break
-        return can_terminate
+    def has_terminator(response, stopterm="", start=0):
+        """ Return length of the final response, 0 if it is not final yet.
+        Response is raw bytes, start is the offset of newly received data. """
+        # Only the tail can hold an end term, so only the tail is inspected.
+        match = _TERM_RE.search(response, max(0, len(response) - _TERM_MAXLEN))
+        end = 0
+        if match:
+            end = len(response)
+            # The line before tells whether the end term is a message body.
+            line = response.rfind(b"\r\n", 0, match.start())
+            line = 0 if line == -1 else line + 2
+            if response.startswith(_BODY_HEADERS, line):
+                end = 0
+
+        # The stopterm inside the response causes immediate halt.
+        # Data before start has been scanned already.
+        if stopterm != "":
+            stop = _STOP_CACHE.get(stopterm)
+            if stop is None:
+                stop = _STOP_CACHE[stopterm] = stopterm.encode("utf-8")
+            index = response.find(stop, max(0, start - len(stop) + 1))
+            if index != -1 and (end == 0 or index + len(stop) < end):
+                end = index + len(stop)
+        return end
 
     def tokenize_response(response):
         """ Chop a response in pieces for parsing. """
-        # First split by newline.
-        table = response.split("\r\n")
-        final_table = []
-
-        for i in range(len(table)):
-            # Remove trailing "\r".
-            el = table[i].replace("\r", "")
-            # Take only nonempty entries".
-            if el != "":
-                final_table.append(el)
-        return final_table
+        # Split by newline, remove stray "\r" and take only nonempty entries.
+        return [el.replace("\r", "") for el in response.split("\r\n")
+                if el.strip("\r")]
+
+    def receive(self, timeout):
+        """ Block until bytes arrive or the timeout passes.
+        Returns the received bytes, empty on timeout. """
+        if self._fd is not None:
+            ready, _, _ = select.select([self._fd], [], [], timeout)
+            if not ready:
+                return b""
+            # Read the descriptor directly, one system call per burst.
+            try:
+                data = os.read(self._fd, _READ_SIZE)
+            except BlockingIOError:
+                return b""
+            if not data:
+                raise SerialException("device reports readiness to read but returned no data")
+            return data
+
+        # Fall back to a blocking read, which returns once a burst of
+        # bytes is followed by the inter byte timeout.
+        self.serial.timeout = timeout
+        return self.serial.read(_READ_SIZE)
+
+    def extract_urcs(self, start=0):
+        """ Move complete unsolicited result codes from the buffer
+        to the urcs queue. Data before start has been scanned already. """
+        buf = self._buf
+        # A URC that was incomplete at the last scan is on its last line.
+        pos = max(0, buf.rfind(b"\r\n", 0, start)) if start else 0
+        if buf.find(b"+CMTI", pos) == -1:
+            return
+        tail = buf[pos:]
+        urcs = _URC_RE.findall(tail)
+        if not urcs:
+            return
+        for urc in urcs:
+            urc = urc.decode("utf-8", errors="replace")
+            logger.debug("URC: %s", urc)
+            self.urcs.put(urc)
+        buf[pos:] = _URC_RE.sub(b"", tail)
+        self._cuts += 1
+
+    def clear_buffer(self):
+        """ Discard the buffer, except a URC that has partly arrived.
+        Returns the discarded bytes. """
+        buf = self._buf
+        index = buf.rfind(b"\r\n")
+        tail = bytes(buf[index:]) if index != -1 else b""
+        if not tail or not (_URC_START.startswith(tail) or tail.startswith(_URC_START)):
+            tail = b"\r" if buf.endswith(b"\r") else b""
+        discarded = bytes(buf[:len(buf) - len(tail)])
+        buf[:] = tail
+        self._cuts += 1
+        return discarded
 
     def read(self, timeout=10, stopterm=""):
         """ Read a single whole response from an AT command.
         Returns a list of tokens for parsing. """
-        resp = ""
-        start_time = time()
-        delay = 0.01
-        while True:
-            avail = self.serial.in_waiting
-            if avail > 0:
-                # Read bytes and check if terminator is contained.
+        # Bytes received after a response are kept for the next read.
+        buf = self._buf
+        start = 0
+        deadline = time() + timeout
+        with self._cond:
+            cuts = self._cuts
+            while True:
+                # Check if terminator is contained.
                 # If it is not a utf-8 string, return error.
-                try:
-                    resp += self.serial.read(avail).decode("utf-8")
-                except:
-                    logger.debug("READ: {:s}".format(resp))
-                    return [resp, Status.ERROR]
-                if AT_Device.has_terminator(resp, stopterm):
-                    logger.debug("READ: {:s}".format(resp))
+                self.extract_urcs(start)
+                # Removed URCs shift the data, so scan it all again.
+                if cuts != self._cuts:
+                    cuts = self._cuts
+                    start = 0
+                end = AT_Device.has_terminator(buf, stopterm, start)
+                if end:
+                    raw = buf[:end]
+                    del buf[:end]
+                    try:
+                        resp = raw.decode("utf-8")
+                    except UnicodeDecodeError:
+                        resp = raw.decode("utf-8", errors="replace")
+                        logger.debug("READ: %s", resp)
+                        return [resp, Status.ERROR]
+                    logger.debug("READ: %s", resp)
                     table = AT_Device.tokenize_response(resp)
                     return table
 
-            if time() - start_time > timeout:
-                return [resp, Status.TIMEOUT]
-                logger.debug("READ: {:s}".format(resp))
-            sleep(delay)
+                start = len(buf)
+                remaining = deadline - time()
+                if remaining <= 0:
+                    resp = self.clear_buffer().decode("utf-8", errors="replace")
+                    logger.debug("READ: %s", resp)
+                    return [resp, Status.TIMEOUT]
+
+                # Wait for the reader thread, or receive ourselves.
+                if self._reader is not None:
+                    self._cond.wait(remaining)
+                else:
+                    buf += self.receive(remaining)
+
+    def await_urc(self, timeout=None):
+        """ Block until an unsolicited result code arrives.
+        Returns the URC, or None if the timeout passes or the
+        reader thread fails. """
+        if self._reader is not None:
+            try:
+                return self.urcs.get(timeout=timeout)
+            except Empty:
+                return None
+
+        # Without a reader thread, receive until a URC shows up.
+        deadline = None if timeout is None else time() + timeout
+        with self._cond:
+            while self.urcs.empty():
+                remaining = 0.5 if deadline is None else deadline - time()
+                if remaining <= 0:
+                    return None
+                start = len(self._buf)
+                self._buf += self.receive(remaining)
+                self.extract_urcs(start)
+        return self.urcs.get()
+
+    def start_reader_thread(self):
+        """ Receive from the serial port in a background thread.
+        URCs are then queued the moment they arrive, also while idle. """
+        if self._reader is not None:
+            return
+        self._reader = threading.Thread(target=self._reader_loop, daemon=True)
+        self._reader.start()
+        logger.debug("Reader thread started")
+
+    def stop_reader_thread(self):
+        """ Stop the background reader thread. """
+        reader = self._reader
+        if reader is None:
+            return
+        with self._cond:
+            self._reader = None
+        # Data it received until now is in the buffer once it has finished.
+        reader.join()
+        # Waiting readers then receive by themselves.
+        with self._cond:
+            self._cond.notify_all()
+        logger.debug("Reader thread stopped")
+
+    def _reader_loop(self):
+        """ Move incoming bytes into the buffer and wake up readers. """
+        reader = threading.current_thread()
+        while self._reader is reader:
+            try:
+                data = self.receive(0.5)
+            except (SerialException, OSError) as e:
+                # Hand receiving back to the callers, which then fail fast.
+                logger.debug("Reader thread failed: %s", e)
+                with self._cond:
+                    if self._reader is reader:
+                        self._reader = None
+                    self.urcs_lost = True
+                    self._cond.notify_all()
+                # Wake up await_urc.
+                self.urcs.put(None)
+                return
+            if data:
+                with self._cond:
+                    start = len(self._buf)
+                    self._buf += data
+                    self.extract_urcs(start)
+                    self._cond.notify_all()
 
     def read_status(self, msg=""):
         """ Returns status of latest response. """
         status = self.read()[-1]
         if status != Status.OK and status != Status.PROMPT:
-            logger.debug("{:s}: {:s}".format(status, msg))
+            logger.debug("%s: %s", status, msg)
         return status
 
+    def await_ok(self, attempts=None, timeout=10):
+        """ Write AT until the device replies OK. Waits longer between each
+        attempt and gives up after the attempts or 3 errors in a row.
+        Attempts None retries forever. Returns status."""
+        delay = 0.1
+        errors = 0
+        attempt = 0
+        while True:
+            self.write("AT")
+            status = self.read(timeout=timeout)[-1]
+            if status == Status.OK:
+                return status
+
+            # An ERROR means the device answers, but rejects AT.
+            errors = errors + 1 if status == Status.ERROR else 0
+            attempt += 1
+            if errors >= 3 or attempt == attempts:
+                return status
+            logger.debug("%s: -> Retrying in %.1fs", status, delay)
+            sleep(delay)
+            delay = min(delay * 2, 2.0)
+
     def sync_baudrate(self, retry=True):
         """ Synchronize the device baudrate to the port.
         You should always call this first. Returns status."""
-        logger.debug("Performing baudrate sync, retry={:s}".format(str(retry)))
+        logger.debug("Performing baudrate sync, retry=%s", retry)
         # Write AT and test whether received OK response.
         # A broken serial port will not reply.
-        while True:
-            self.write("AT")
-            status = self.read(timeout=5)[-1]
-            if status == Status.OK:
-                logger.debug("Succesful")
-                return status
-            elif retry:
-                logger.debug("-> Retrying")
-            else:
-                logger.debug("Failure")
+        status = self.await_ok(None if retry else 1, timeout=5)
+        if status == Status.OK:
+            logger.debug("Succesful")
+        else:
+            logger.debug("Failure")
+        return status
 
     def reset_state(self):
-        """ Ensures the state of the AT device is on par for a new environment. """
-        # Read all remaining bytes.
-        if self.serial.in_waiting > 0:
-            self.serial.read(self.serial.in_waiting)
+        """ Ensures the state of the AT device is on par for a new environment.
+        Returns status. """
+        # Read all remaining bytes, but keep the URCs.
+        with self._cond:
+            if self._reader is None and self.serial.in_waiting > 0:
+                self._buf += self.serial.read(self.serial.in_waiting)
+            self.extract_urcs()
+            self.clear_buffer()
         # Write AT status message.
-        for i in range(0, 10):
-            self.write("AT")
-            status = self.read_status()
-            if status == Status.OK:
-                break
+        return self.await_ok(10)
 
 
 class GSM_Device(AT_Device):
@@ -156,16 +376,69 @@ class GSM_Device(AT_Device):
     def __init__(self, path, baudrate=9600):
         """ Open GSM Device. Device sim still needs to be unlocked. """
         logger.debug("Opening GSM device")
+        # Last configured modes, None if unknown.
+        self._cmgf = None
+        self._cnmi = None
         super().__init__(path, baudrate)
-        while self.sync_baudrate() != Status.OK:
-            sleep(1)
+        if self.sync_baudrate() != Status.OK:
+            logger.debug("GSM device rejects AT commands")
+        self.configure()
+
+    def configure(self):
+        """ Set text mode and enable new message notifications
+        in a single round trip. Returns status. """
+        self.write_batch(["AT+CMGF=1", "AT+CNMI=2,1,0,0,0"])
+        status = self.read_status("Configuring")
+        if status == Status.OK:
+            self._cmgf = 1
+            self._cnmi = True
+            self.urcs_lost = True
+            return status
+        # Find out which one is not supported.
+        self.set_text_mode()
+        return self.enable_sms_notify()
+
+    def read(self, timeout=10, stopterm=""):
+        """ Read a single whole response from an AT command.
+        Forgets the configured modes on error. """
+        resp = super().read(timeout, stopterm)
+        if resp[-1] == Status.ERROR or resp[-1] == Status.TIMEOUT:
+            self._cmgf = None
+        return resp
 
     def reboot(self):
         """ Reboot the GSM device. Returns status. """
         logger.debug("Rebooting GSM device")
+        self._cmgf = None
+        self._cnmi = None
         self.write("AT+CFUN=1,1")
         return self.read_status("Rebooting")
 
+    def set_text_mode(self):
+        """ Set text mode for messages, if not set already. Returns status. """
+        if self._cmgf == 1:
+            return Status.OK
+        self.write("AT+CMGF=1")
+        status = self.read_status("Text mode")
+        if status == Status.OK:
+            self._cmgf = 1
+        return status
+
+    def enable_sms_notify(self):
+        """ Have the modem announce new messages with a +CMTI URC.
+        Without it, awaiting messages falls back to polling. Returns status. """
+        if self._cnmi is not None:
+            return Status.OK if self._cnmi else Status.ERROR
+        self.write("AT+CNMI=2,1,0,0,0")
+        status = self.read_status("New message notifications")
+        # Only a definite answer is remembered, a busy modem is asked again.
+        if status == Status.OK or status == Status.ERROR:
+            self._cnmi = status == Status.OK
+        # Messages received before this were not announced.
+        if status == Status.OK:
+            self.urcs_lost = True
+        return status
+
     def get_sim_status(self):
         """ Returns status of sim lock. True of locked. """
         self.reset_state()
@@ -186,8 +459,8 @@ class GSM_Device(AT_Device):
             return Status.OK
 
         # Unlock sim.
-        logger.debug("Trying SIM pin={:s}".format(pin))
-        self.write("AT+CPIN={:s}".format(pin))
+        logger.debug("Trying SIM pin=%s", pin)
+        self.write(_CPIN(pin))
         status = self.read_status("Setting pin")
         if status != Status.OK:
             return status
@@ -196,6 +469,10 @@ class GSM_Device(AT_Device):
         logger.debug("Awaiting SMS ready status")
         self.read(stopterm="SMS Ready")
         logger.debug("Sim unlocked")
+        # Settings may have been refused while the sim was locked.
+        self._cmgf = None
+        self._cnmi = None
+        self.configure()
         return Status.OK
 
     def send_sms(self, nr, msg):
@@ -203,21 +480,18 @@ class GSM_Device(AT_Device):
         Returns status."""
         self.reset_state()
         # Set text mode.
-        logger.debug("Sending \"{:s}\" to {:s}.".format(msg, nr))
-        self.write("AT+CMGF=1")
-        status = self.read_status("Text mode")
+        logger.debug("Sending \"%s\" to %s.", msg, nr)
+        status = self.set_text_mode()
         if status != Status.OK:
             return status
 
         # Write message.
-        self.write("AT+CMGS=\"{:s}\"".format(nr))
+        self.write(_CMGS(nr))
         status = self.read_status("Set number")
         if status != Status.PROMPT:
             return status
 
-        self.write(msg)
-        self.read()
-        self.write_ctrlz()
+        self.write_ctrlz(msg)
         status = self.read_status("Sending message")
 
         logger.debug("Message sent.")
@@ -227,14 +501,13 @@ class GSM_Device(AT_Device):
         """ Receive text messages. See types of message from SMS_Group class. """
         self.reset_state()
         # Read unread. After reading they will not show up here anymore!
-        logger.debug("Scanning {:s} messages...".format(group))
-        self.write("AT+CMGF=1")
-        status = self.read_status("Text mode")
+        logger.debug("Scanning %s messages...", group)
+        status = self.set_text_mode()
         if status != Status.OK:
             return status
 
         # Read the messages.
-        self.write("AT+CMGL=\"{:s}\"".format(group))
+        self.write(_CMGL(group))
         resp = self.read()
         if resp[-1] != Status.OK:
             return resp[-1]
@@ -244,16 +517,87 @@ class GSM_Device(AT_Device):
         table = []
         for i in range(1, len(resp) - 1, 2):
             header = resp[i].split(",")
-            message = resp[i + 1]
-
-            # Extract elements and strip garbage.
-            sender = header[2].replace("\"", "")
-            date = header[4].replace("\"", "")
-            time = header[5].split("+")[0]
-            el = [sender, date, time, message]
-            table.append(el)
+            table.append(GSM_Device.parse_sms(header[1:], resp[i + 1]))
+        return table
+
+    def read_sms(self, index, group=SMS_Group.ALL):
+        """ Read a single text message at the modem index.
+        Returns [sender, date, time, message] or status.
+        A message outside group is not returned, status is then UNKNOWN. """
+        status = self.set_text_mode()
+        if status != Status.OK:
+            return status
+
+        self.write(_CMGR(index))
+        resp = self.read()
+        if resp[-1] != Status.OK:
+            return resp[-1]
+
+        # Elements are echo, header, message and result. Leftovers
+        # like RING may come first, so look for the header.
+        for i in range(len(resp) - 2):
+            if resp[i].startswith("+CMGR:"):
+                break
+        else:
+            return Status.UNKNOWN
+        header = resp[i].split(",")
+        # Drafts have no date and time.
+        if len(header) < 5:
+            return Status.UNKNOWN
+        if group != SMS_Group.ALL and group not in header[0]:
+            return Status.UNKNOWN
+        return GSM_Device.parse_sms(header, resp[i + 1])
+
+    def parse_sms(header, message):
+        """ Convert a split message header starting at the group into
+        [sender, date, time, message]. The header needs 5 fields. """
+        # Extract elements and strip garbage.
+        sender = header[1].replace("\"", "")
+        date = header[3].replace("\"", "")
+        time = header[4].split("+")[0]
+        return [sender, date, time, message]
+
+    def await_sms(self, timeout=10):
+        """ Block until new messages arrive and receive them.
+        Returns a list like receive_sms, empty if there are none. """
+        if self.enable_sms_notify() != Status.OK:
+            # Without notifications, scan unread messages after the timeout.
+            self.await_urc(timeout)
+            table = self.receive_sms()
+            if not isinstance(table, list):
+                return []
+            return table
+
+        # Scan once for messages that were never announced.
+        # The scan also covers the pending notifications.
+        if self.urcs_lost:
+            self.urcs_lost = False
+            while self.await_urc(0) is not None:
+                pass
+            table = self.receive_sms()
+            if not isinstance(table, list):
+                return []
+            return table
+
+        # Read only the messages at the announced indices.
+        table = []
+        urc = self.await_urc(timeout)
+        while urc is not None:
+            match = _CMTI_RE.match(urc)
+            if match:
+                # The message may already have been read by a scan.
+                el = self.read_sms(int(match.group(1)), SMS_Group.UNREAD)
+                if isinstance(el, list):
+                    table.append(el)
+            urc = self.await_urc(0)
         return table
 
+    def delete_sms(self, index):
+        """ Delete the text message at the modem index. Returns status. """
+        self.reset_state()
+        self.write(_CMGD(index))
+        return self.read_status("Deleting message")
+
     def delete_read_sms(self):
         """ Delete all messages except unread. Including drafts. """
         self.reset_state()
@@ -0,0 +1 @@
+# Lets the tests import atlib from the repository root.
@@ -11,6 +11,7 @@ else:
     print("SIM already unlocked.")
 
 print("Opening Server")
+gsm.start_reader_thread()
 while True:
     recv = gsm.await_sms()
     if len(recv) > 0:
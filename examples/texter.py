@@ -4,7 +4,7 @@
 from atlib import *
 
 gsm = GSM_Device("/dev/serial0")
-if gsm.is_sim_locked():
+if gsm.get_sim_status() != Status.OK:
     pin = input("SIM Pin: ")
     gsm.unlock_sim(pin)
 else:
@@ -15,5 +15,5 @@ while True:
     nr = input("Phone number: ")
     msg = input("Message: ")
 
-    if gsm.send_sms(nr, msg) != OK:
+    if gsm.send_sms(nr, msg) != Status.OK:
         print("Error sending message.")
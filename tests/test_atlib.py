@@ -0,0 +1,302 @@
+from time import sleep, time
+import os
+import struct
+import threading
+
+import pytest
+
+import atlib
+from atlib import AT_Device, GSM_Device, SMS_Group, Status
+
+
+class FakeSerial:
+    """ Serial port without a file descriptor, fed with chunks of bytes.
+    Writing a known command queues its reply. """
+
+    replies = {}
+
+    def __init__(self, path, timeout=None, baudrate=9600):
+        self.timeout = timeout
+        self.inter_byte_timeout = None
+        self.chunks = []
+        self.written = bytearray()
+        self.replies = dict(self.replies)
+
+    @property
+    def in_waiting(self):
+        return len(self.chunks[0]) if self.chunks else 0
+
+    def read(self, size=1):
+        return self.chunks.pop(0) if self.chunks else b""
+
+    def write(self, data):
+        self.written += data
+        reply = self.replies.get(bytes(data))
+        if isinstance(reply, list):
+            self.chunks.extend(reply)
+        elif reply is not None:
+            self.chunks.append(reply)
+        return len(data)
+
+    def close(self):
+        pass
+
+
+class PtySerial:
+    """ Serial port on the slave side of a pseudo terminal. """
+
+    fd = None
+
+    def __init__(self, path, timeout=None, baudrate=9600):
+        self.timeout = timeout
+
+    def fileno(self):
+        return self.fd
+
+    @property
+    def in_waiting(self):
+        import fcntl
+        import termios
+        return struct.unpack("i", fcntl.ioctl(self.fd, termios.FIONREAD, b"\0" * 4))[0]
+
+    def read(self, size=1):
+        try:
+            return os.read(self.fd, size)
+        except BlockingIOError:
+            return b""
+
+    def write(self, data):
+        return os.write(self.fd, data)
+
+    def close(self):
+        pass
+
+
+HEADER = b'"REC UNREAD","+3161","","24/01/01,10:00:00+04"'
+REPLIES = {
+    b"AT\r\n": b"AT\r\r\nOK\r\n",
+    b"AT+CMGF=1;+CNMI=2,1,0,0,0\r\n": b"AT+CMGF=1;+CNMI=2,1,0,0,0\r\r\nOK\r\n",
+    b"AT+CMGR=3\r\n": b"AT+CMGR=3\r\r\n+CMGR: " + HEADER + b"\r\nOK\r\n\r\nOK\r\n",
+    b'AT+CMGL="REC UNREAD"\r\n': b'AT+CMGL="REC UNREAD"\r\r\n+CMGL: 1,' + HEADER
+    + b"\r\nhello\r\n\r\nOK\r\n",
+    b'AT+CMGS="+3161"\r\n': b'AT+CMGS="+3161"\r\r\n> ',
+    b"hi\x1a": b"hi\x1a\r\n+CMGS: 5\r\n\r\nOK\r\n",
+    b"AT+CMGD=3\r\n": b"AT+CMGD=3\r\r\nOK\r\n",
+}
+
+
+@pytest.fixture
+def fake_serial(monkeypatch):
+    monkeypatch.setattr(atlib, "Serial", FakeSerial)
+    monkeypatch.setattr(FakeSerial, "replies", REPLIES)
+
+
+@pytest.fixture
+def device(fake_serial):
+    return AT_Device("/dev/null")
+
+
+@pytest.fixture
+def gsm(fake_serial):
+    return GSM_Device("/dev/null")
+
+
+@pytest.fixture
+def pty(monkeypatch):
+    """ Returns a device on a pseudo terminal and the modem side of it. """
+    if not hasattr(os, "openpty"):
+        pytest.skip("needs a pseudo terminal")
+    import tty
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    os.set_blocking(slave, False)
+    monkeypatch.setattr(atlib, "Serial", PtySerial)
+    monkeypatch.setattr(PtySerial, "fd", slave)
+    device = AT_Device("/dev/null")
+    modem = {"fd": master}
+    yield device, modem
+    device.stop_reader_thread()
+    os.close(slave)
+    if modem["fd"] is not None:
+        os.close(modem["fd"])
+
+
+def test_read_body_ok(device):
+    # The body arrives in its own burst and must not end the response.
+    device.serial.chunks = [b"AT+CMGR=3\r\r\n+CMGR: " + HEADER + b"\r\nOK\r\n", b"\r\nOK\r\n"]
+    assert device.read(timeout=1) == ["AT+CMGR=3", "+CMGR: " + HEADER.decode(), "OK", "OK"]
+    assert device._buf == b""
+
+    device.serial.chunks = [b'AT+CMGL="ALL"\r\r\n+CMGL: 1,' + HEADER + b"\r\nERROR\r\n", b"\r\nOK\r\n"]
+    assert device.read(timeout=1)[-2:] == ["ERROR", "OK"]
+
+
+def test_read_split_urc(device):
+    device.serial.chunks = [b'AT+CMGF=1\r\r\n+CMTI: "SM",', b'3\r\n\r\nOK\r\n']
+    start = time()
+    assert device.read(timeout=2, stopterm="SMS Ready") == ["AT+CMGF=1", "OK"]
+    assert time() - start < 1
+    assert device.await_urc(0) == '+CMTI: "SM",3'
+
+
+def test_read_keeps_leftover(device):
+    device.serial.chunks = [b"\r\nSMS Ready\r\n\r\nOK\r\n"]
+    assert device.read(timeout=1, stopterm="SMS Ready") == ["SMS Ready"]
+    assert device.read(timeout=1) == ["OK"]
+
+
+def test_read_timeout_keeps_partial_urc(device):
+    device.serial.chunks = [b'junk\r\n+CMTI: "SM",']
+    assert device.read(timeout=0.05) == ["junk", Status.TIMEOUT]
+    device.serial.chunks = [b"4\r\n"]
+    assert device.await_urc(1) == '+CMTI: "SM",4'
+
+
+def test_write_batch(device):
+    device.write_batch(["AT+CMGF=1", "AT+CNMI=2,1,0,0,0"])
+    assert device.serial.written == b"AT+CMGF=1;+CNMI=2,1,0,0,0\r\n"
+    assert device.read_status() == Status.OK
+
+
+def test_send_sms(gsm):
+    assert gsm.send_sms("+3161", "hi") == Status.OK
+    assert gsm.serial.written.endswith(b'AT+CMGS="+3161"\r\nhi\x1a')
+
+
+def test_read_sms(gsm):
+    assert gsm.read_sms(3) == ["+3161", "24/01/01", "10:00:00", "OK"]
+    assert gsm.read_sms(3, SMS_Group.READ) == Status.UNKNOWN
+
+
+def test_delete_sms(gsm):
+    assert gsm.delete_sms(3) == Status.OK
+    assert gsm.serial.written.endswith(b"AT+CMGD=3\r\n")
+
+
+def test_await_sms(gsm):
+    # The first call scans for messages that were not announced.
+    assert gsm.await_sms(0) == [["+3161", "24/01/01", "10:00:00", "hello"]]
+    gsm.serial.chunks = [b'\r\n+CMTI: "SM",3\r\n']
+    assert gsm.await_sms(1) == [["+3161", "24/01/01", "10:00:00", "OK"]]
+
+
+def test_read_sms_draft(gsm):
+    gsm.serial.replies[b"AT+CMGR=4\r\n"] = b'AT+CMGR=4\r\r\n+CMGR: "STO UNSENT","+3161",""\r\nhi\r\n\r\nOK\r\n'
+    assert gsm.read_sms(4) == Status.UNKNOWN
+
+
+def test_read_sms_after_leftover(gsm):
+    gsm.serial.chunks = [b"\r\nRING\r\n"]
+    assert gsm.read_sms(3) == ["+3161", "24/01/01", "10:00:00", "OK"]
+
+
+def test_read_urc_in_many_chunks(device):
+    device.serial.chunks = [b'AT\r\r\n+CMTI: "S', b'M",1', b'2\r\n', b"\r\nOK\r\n"]
+    assert device.read(timeout=1) == ["AT", "OK"]
+    assert device.await_urc(0) == '+CMTI: "SM",12'
+
+
+def test_configure_fallback(fake_serial, monkeypatch):
+    replies = dict(REPLIES)
+    replies[b"AT+CMGF=1;+CNMI=2,1,0,0,0\r\n"] = b"AT+CMGF=1;+CNMI=2,1,0,0,0\r\r\nERROR\r\n"
+    replies[b"AT+CMGF=1\r\n"] = b"AT+CMGF=1\r\r\nOK\r\n"
+    replies[b"AT+CNMI=2,1,0,0,0\r\n"] = b"AT+CNMI=2,1,0,0,0\r\r\nERROR\r\n"
+    monkeypatch.setattr(FakeSerial, "replies", replies)
+    gsm = GSM_Device("/dev/null")
+    assert gsm.serial.written.endswith(b"AT+CMGF=1\r\nAT+CNMI=2,1,0,0,0\r\n")
+    assert gsm.set_text_mode() == Status.OK
+    assert gsm.enable_sms_notify() == Status.ERROR
+    # Without notifications, awaiting messages polls.
+    assert gsm.await_sms(0) == [["+3161", "24/01/01", "10:00:00", "hello"]]
+
+
+def test_sync_baudrate_no_retry(device):
+    device.serial.replies[b"AT\r\n"] = b"AT\r\r\nERROR\r\n"
+    assert device.sync_baudrate(retry=False) == Status.ERROR
+    assert device.serial.written == b"AT\r\n"
+
+
+def test_await_ok_gives_up_on_errors(device, monkeypatch):
+    delays = []
+    monkeypatch.setattr(atlib, "sleep", delays.append)
+    device.serial.replies[b"AT\r\n"] = b"AT\r\r\nERROR\r\n"
+    assert device.await_ok() == Status.ERROR
+    assert device.serial.written == b"AT\r\n" * 3
+    assert delays == [0.1, 0.2]
+
+
+def test_get_sim_status(gsm):
+    gsm.serial.replies[b"AT+CPIN?\r\n"] = b"AT+CPIN?\r\r\n+CPIN: READY\r\n\r\nOK\r\n"
+    assert gsm.get_sim_status() == Status.OK
+
+
+def test_unlock_sim(gsm):
+    gsm.serial.replies[b"AT+CPIN?\r\n"] = b"AT+CPIN?\r\r\n+CPIN: SIM PIN\r\n\r\nOK\r\n"
+    gsm.serial.replies[b"AT+CPIN=1234\r\n"] = [b"AT+CPIN=1234\r\r\nOK\r\n",
+                                               b"\r\n+CPIN: READY\r\n\r\nSMS Ready\r\n"]
+    assert gsm.unlock_sim("1234") == Status.OK
+    assert gsm.serial.written.endswith(b"AT+CPIN=1234\r\nAT+CMGF=1;+CNMI=2,1,0,0,0\r\n")
+
+
+def test_reboot(gsm):
+    gsm.serial.replies[b"AT+CFUN=1,1\r\n"] = b"AT+CFUN=1,1\r\r\nOK\r\n"
+    assert gsm.reboot() == Status.OK
+    assert gsm._cmgf is None and gsm._cnmi is None
+
+
+def test_receive_sms_read(gsm):
+    gsm.serial.replies[b'AT+CMGL="REC READ"\r\n'] = (
+        b'AT+CMGL="REC READ"\r\r\n+CMGL: 2,"REC READ","+3162","","24/01/02,11:00:00+04"\r\n'
+        b"bye\r\n\r\nOK\r\n")
+    assert gsm.receive_sms(SMS_Group.READ) == [["+3162", "24/01/02", "11:00:00", "bye"]]
+
+
+def test_delete_read_sms(gsm):
+    gsm.serial.replies[b"AT+CMGD=1,3\r\n"] = b"AT+CMGD=1,3\r\r\nOK\r\n"
+    assert gsm.delete_read_sms() == Status.OK
+
+
+def test_receive_pty(pty):
+    device, modem = pty
+    assert device.receive(0.05) == b""
+    os.write(modem["fd"], b"AT\r\r\nOK\r\n")
+    assert device.read(timeout=1) == ["AT", "OK"]
+
+
+def test_reader_thread(pty):
+    device, modem = pty
+    device.start_reader_thread()
+    os.write(modem["fd"], b'AT\r\r\n\r\n+CMTI: "SM",5\r\n\r\nOK\r\n')
+    assert device.read(timeout=1) == ["AT", "OK"]
+    assert device.await_urc(1) == '+CMTI: "SM",5'
+    device.stop_reader_thread()
+    assert device._reader is None
+
+
+def test_stop_reader_thread_while_reading(pty):
+    device, modem = pty
+    device.start_reader_thread()
+    result = []
+    reading = threading.Thread(target=lambda: result.append(device.read(timeout=3)))
+    reading.start()
+    sleep(0.1)
+    start = time()
+    device.stop_reader_thread()
+    os.write(modem["fd"], b"AT\r\r\nOK\r\n")
+    reading.join()
+    assert result == [["AT", "OK"]]
+    assert time() - start < 2
+    # Nothing is left over for the next command.
+    assert device.read(timeout=0.1) == ["", Status.TIMEOUT]
+
+
+def test_reader_thread_death(pty):
+    device, modem = pty
+    device.start_reader_thread()
+    os.close(modem["fd"])
+    modem["fd"] = None
+    assert device.await_urc(2) is None
+    assert device._reader is None
+    assert device.urcs_lost
+    with pytest.raises(OSError):
+        device.read(timeout=1)